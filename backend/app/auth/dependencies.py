@@ -1,11 +1,16 @@
 from fastapi import Header, Depends, HTTPException, APIRouter
 import os, jwt
-from google.cloud import firestore
+from functools import lru_cache
 
 router = APIRouter()
-db = firestore.Client()
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+@lru_cache(maxsize=1)
+def get_firestore():
+    """Create the Firestore client on first use rather than at import"""
+    from google.cloud import firestore
+    return firestore.Client()
+
 def current_user(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(401, "Missing token")
@@ -18,5 +23,5 @@ def current_user(authorization: str = Header(None)):
 
 @router.get("/me")
 def me(user_id: str = Depends(current_user)):
-    doc = db.collection("users").document(user_id).get()
+    doc = get_firestore().collection("users").document(user_id).get()
     return {"user_id": user_id, **(doc.to_dict() or {})}
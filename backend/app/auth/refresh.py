@@ -1,10 +1,9 @@
 import requests, datetime, os
 from fastapi import HTTPException
-from google.cloud import firestore
-
-db = firestore.Client()
+from .dependencies import get_firestore
 
 def get_valid_access_token(user_id: str) -> str:
+    db = get_firestore()
     doc = db.collection("users").document(user_id).get()
     if not doc.exists:
         raise HTTPException(404, "User not found")
@@ -0,0 +1,48 @@
+"""
+Explicit schema setup, kept out of app import so workers start without touching the DB
+
+    python -m app.db.init_db
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+from .database import engine
+from .models import Base
+
+# Columns added after their table first shipped; create_all only creates missing tables
+ADDED_COLUMNS = {
+    "users": {
+        "data_version": "INTEGER NOT NULL DEFAULT 0",
+        "last_ingest_at": "TIMESTAMP WITH TIME ZONE",
+    },
+}
+
+def _column_names(table: str) -> set:
+    return {c["name"] for c in inspect(engine).get_columns(table)}
+
+def _add_column(table: str, name: str, ddl: str):
+    """Add a column, tolerating another worker adding it at the same time"""
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {ddl}"))
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+    except DBAPIError:
+        # Duplicate column if we lost the race; anything else is a real error
+        if name not in _column_names(table):
+            raise
+
+def init_db():
+    """Create any missing tables and columns"""
+    Base.metadata.create_all(bind=engine)
+
+    for table, columns in ADDED_COLUMNS.items():
+        existing = _column_names(table)
+        for name, ddl in columns.items():
+            if name not in existing:
+                _add_column(table, name, ddl)
+
+if __name__ == "__main__":
+    init_db()
+    print("Database tables created")
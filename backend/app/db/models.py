@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, DateTime, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, Float, Date, DateTime, Text, LargeBinary, ForeignKey, UniqueConstraint
 from sqlalchemy.sql import func
 from .database import Base
 
@@ -11,6 +11,9 @@ class User(Base):
     refresh_token = Column(Text)
     token_expiry = Column(DateTime(timezone=True))
     profile_pic_url = Column(Text)
+    # Bumped whenever new listening history lands, so clients can skip unchanged refetches
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")
+    last_ingest_at = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -31,4 +34,69 @@ class ListeningHistory(Base):
     
     __table_args__ = (
         UniqueConstraint('user_id', 'track_id', 'played_at', name='uix_user_track_played'),
-    )
\ No newline at end of file
+    )
+
+class TrendingStat(Base):
+    """Top artists/tracks per cohort and timeframe, rebuilt by the aggregation job"""
+    __tablename__ = "trending_stats"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cohort = Column(String(32), nullable=False)
+    timeframe = Column(String(16), nullable=False)
+    kind = Column(String(16), nullable=False)  # "artist" or "track"
+    rank = Column(Integer, nullable=False)
+    item_id = Column(String(255), nullable=False)
+    item_name = Column(String(500))
+    artist_name = Column(String(500))
+    play_count = Column(Integer)
+    previous_play_count = Column(Integer)
+    unique_listeners = Column(Integer)
+    computed_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        UniqueConstraint('cohort', 'timeframe', 'kind', 'rank', name='uix_trending_rank'),
+    )
+
+class GlobalStat(Base):
+    """Cross-user totals per cohort and timeframe, rebuilt by the aggregation job"""
+    __tablename__ = "global_stats"
+    
+    cohort = Column(String(32), primary_key=True)
+    timeframe = Column(String(16), primary_key=True)
+    total_plays = Column(Integer)
+    total_minutes = Column(Float)
+    unique_listeners = Column(Integer)
+    unique_artists = Column(Integer)
+    computed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class TrendingBucket(Base):
+    """Serialized sketches for one cohort's plays on one UTC day, so aggregation resumes after restarts"""
+    __tablename__ = "trending_buckets"
+    
+    cohort = Column(String(32), primary_key=True)
+    day = Column(Date, primary_key=True)
+    sketch = Column(LargeBinary, nullable=False)  # HLL registers and count-min counters
+    meta = Column(Text, nullable=False)  # JSON: totals, candidates and the layout of sketch
+
+class AggregationCheckpoint(Base):
+    """Last listening_history id folded into a batch aggregation; its row also serializes runs"""
+    __tablename__ = "aggregation_checkpoints"
+    
+    name = Column(String(64), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+
+class ImportJob(Base):
+    """Progress of a streaming history upload, shared by every API worker"""
+    __tablename__ = "import_jobs"
+    
+    job_id = Column(String(32), primary_key=True)
+    user_id = Column(String(255), ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False)
+    status = Column(String(16), nullable=False)
+    entries = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    imported = Column(Integer, nullable=False, default=0)
+    duplicates = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    path = Column(Text)  # spooled upload, removed once the job finishes
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,45 @@
+"""
+Offline import of Spotify extended streaming history downloads
+
+    python -m app.import_history USER_ID Streaming_History_Audio_*.json
+    python -m app.import_history USER_ID my_spotify_data.zip
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import sys
+import time
+
+from .db.database import SessionLocal
+from .services.db_service import DBService
+from .services.history_import import import_history_file, IMPORT_BATCH_ROWS
+
+def main():
+    parser = argparse.ArgumentParser(description="Import Spotify extended streaming history for a user")
+    parser.add_argument("user_id", help="Spotify user id (must have logged in once)")
+    parser.add_argument("files", nargs="+", help=".json history files or the .zip download")
+    parser.add_argument("--batch-rows", type=int, default=IMPORT_BATCH_ROWS, help="Rows per insert transaction")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if not DBService.get_user(db, args.user_id):
+            sys.exit(f"User {args.user_id} not found")
+    finally:
+        db.close()
+
+    for path in args.files:
+        started = time.monotonic()
+
+        def progress(stats):
+            rate = stats["entries"] / max(time.monotonic() - started, 1e-6)
+            print(f"\r{path}: {stats['entries']} entries, {stats['imported']} imported, "
+                  f"{stats['duplicates']} duplicates ({rate:.0f}/s)", end="", flush=True)
+
+        stats = import_history_file(args.user_id, path, args.batch_rows, progress)
+        progress(stats)
+        print(f"\n{path}: done, {stats['skipped']} podcast/short plays skipped")
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,50 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 import os
+import asyncio
+import json
 from contextlib import asynccontextmanager
+from datetime import date
+from typing import Optional, Dict, Any, List
+from pydantic import BaseModel
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-from .db.database import engine, get_db
-from .db.models import Base
-from .scheduler import start_scheduler, stop_scheduler
+from .db.database import get_db, SessionLocal
 from .routes_auth import router as auth_router
-from .services.db_service import DBService
+from .services.db_service import DBService, SERIES_BUCKETS
+from .services.trending import TIMEFRAMES, ALL_USERS
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+def _env_flag(name: str, default: str = "true") -> bool:
+    return os.getenv(name, default).lower() not in ("0", "false", "no")
+
+# Set to false when polling runs in its own process (python -m app.poller)
+RUN_SCHEDULER = _env_flag("RUN_SCHEDULER")
+# Set to false when tables are created by a release step (python -m app.db.init_db)
+INIT_DB_ON_STARTUP = _env_flag("INIT_DB_ON_STARTUP")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     # Startup
     print("Starting up...")
-    start_scheduler()  # Start the hourly polling
+    if INIT_DB_ON_STARTUP:
+        from .db.init_db import init_db
+        init_db()  # Create database tables
+    if RUN_SCHEDULER:
+        # Imported here so API-only workers never load APScheduler or the poller
+        from .scheduler import start_scheduler
+        start_scheduler()  # Start the hourly polling
     yield
     # Shutdown
     print("Shutting down...")
-    stop_scheduler()
+    if RUN_SCHEDULER:
+        from .scheduler import stop_scheduler
+        stop_scheduler()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -43,35 +62,33 @@ app.include_router(auth_router)
 def health():
     return {"ok": True}
 
-@app.get("/api/user/{user_id}/history")
-def get_user_history(user_id: str, limit: int = 100, offset: int = 0, db: Session = Depends(get_db)):
-    """Get listening history for a user"""
-    history = DBService.get_user_listening_history(db, user_id, limit, offset)
+def _track_item(h) -> dict:
+    return {
+        "track_id": h.track_id,
+        "track_name": h.track_name,
+        "artist_name": h.artist_name,
+        "artist_id": h.artist_id,
+        "album_name": h.album_name,
+        "played_at": h.played_at.isoformat(),
+        "duration_ms": h.duration_ms,
+        "image_url": h.image_url,
+    }
+
+def _history_payload(user_id: str, history, limit: int, offset: int) -> dict:
     return {
         "user_id": user_id,
-        "tracks": [
-            {
-                "track_id": h.track_id,
-                "track_name": h.track_name,
-                "artist_name": h.artist_name,
-                "artist_id": h.artist_id,
-                "album_name": h.album_name,
-                "played_at": h.played_at.isoformat(),
-                "duration_ms": h.duration_ms,
-                "image_url": h.image_url,
-            }
-            for h in history
-        ],
+        "tracks": [_track_item(h) for h in history],
         "limit": limit,
         "offset": offset,
     }
 
-@app.get("/api/user/{user_id}/recent-tracks")
-def get_recent_tracks(user_id: str, limit: int = 20, db: Session = Depends(get_db)):
-    """Get recent tracks for AI analysis"""
-    history = DBService.get_user_listening_history(db, user_id, limit, 0)
-    user = DBService.get_user(db, user_id)
-    
+@app.get("/api/user/{user_id}/history")
+def get_user_history(user_id: str, limit: int = 100, offset: int = 0, db: Session = Depends(get_db)):
+    """Get listening history for a user"""
+    history = DBService.get_user_listening_history(db, user_id, limit, offset)
+    return _history_payload(user_id, history, limit, offset)
+
+def _recent_tracks_payload(user_id: str, user, history) -> dict:
     return {
         "user": {
             "id": user.user_id if user else user_id,
@@ -89,6 +106,99 @@ def get_recent_tracks(user_id: str, limit: int = 20, db: Session = Depends(get_d
         "track_count": len(history)
     }
 
+@app.get("/api/user/{user_id}/recent-tracks")
+def get_recent_tracks(user_id: str, limit: int = 20, db: Session = Depends(get_db)):
+    """Get recent tracks for AI analysis"""
+    history = DBService.get_user_listening_history(db, user_id, limit, 0)
+    user = DBService.get_user(db, user_id)
+    return _recent_tracks_payload(user_id, user, history)
+
+# Seconds between version checks for each open version stream
+VERSION_STREAM_INTERVAL = float(os.getenv("VERSION_STREAM_INTERVAL", "5"))
+
+def _version_payload(user_id: str, version) -> dict:
+    return {
+        "user_id": user_id,
+        "data_version": version.data_version,
+        "last_ingest_at": version.last_ingest_at.isoformat() if version.last_ingest_at else None,
+    }
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison against an If-None-Match list, as caches and browsers send it"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+@app.get("/api/user/{user_id}/version")
+def get_data_version(user_id: str, request: Request, response: Response, db: Session = Depends(get_db)):
+    """Get the user's data version; send If-None-Match to get 304 when nothing changed"""
+    version = DBService.get_data_version(db, user_id)
+    if not version:
+        raise HTTPException(404, "User not found")
+    etag = f'"{version.data_version}"'
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return _version_payload(user_id, version)
+
+def _read_data_version(user_id: str):
+    db = SessionLocal()
+    try:
+        return DBService.get_data_version(db, user_id)
+    finally:
+        db.close()
+
+@app.get("/api/user/{user_id}/version/stream")
+async def stream_data_version(user_id: str, request: Request):
+    """Server-sent events: pushes the data version whenever it changes"""
+    from starlette.concurrency import run_in_threadpool
+
+    async def events():
+        last = None
+        while not await request.is_disconnected():
+            version = await run_in_threadpool(_read_data_version, user_id)
+            if version is None:
+                yield "event: error\ndata: {\"error\": \"User not found\"}\n\n"
+                return
+            if version.data_version != last:
+                last = version.data_version
+                yield f"id: {last}\nevent: version\ndata: {json.dumps(_version_payload(user_id, version))}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(VERSION_STREAM_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/api/user/{user_id}/listening-series")
+def get_listening_series(user_id: str, start_date: date, end_date: date, bucket: str = "day",
+                         tz: str = "UTC", artist_id: Optional[str] = None, db: Session = Depends(get_db)):
+    """Get minutes and plays per day/week/month for charts"""
+    if bucket not in SERIES_BUCKETS:
+        raise HTTPException(400, f"bucket must be one of {', '.join(SERIES_BUCKETS)}")
+    if end_date < start_date:
+        raise HTTPException(400, "end_date must not be before start_date")
+    if (end_date - start_date).days > 366 * 5:
+        raise HTTPException(400, "Date range too large")
+    try:
+        ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(400, f"Unknown timezone: {tz}")
+
+    series = DBService.get_listening_series(db, user_id, start_date, end_date, bucket, tz, artist_id)
+    return {
+        "user_id": user_id,
+        "bucket": bucket,
+        "timezone": tz,
+        "artist_id": artist_id,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "series": series,
+    }
+
 @app.get("/api/user/{user_id}/top-artists")
 def get_top_artists(user_id: str, limit: int = 10, timeframe: str = "month", db: Session = Depends(get_db)):
     """Get top artists for a user"""
@@ -114,6 +224,142 @@ def get_listening_stats(user_id: str, timeframe: str = "week", db: Session = Dep
         "avg_daily_minutes": 0
     }
 
+@app.get("/api/stats/global")
+def get_global_stats(timeframe: str = "week", cohort: str = ALL_USERS, db: Session = Depends(get_db)):
+    """Get cross-user listening totals (approximate unique counts)"""
+    if timeframe not in TIMEFRAMES:
+        raise HTTPException(400, f"timeframe must be one of {', '.join(TIMEFRAMES)}")
+    stat = DBService.get_global_stats(db, timeframe, cohort)
+    return {
+        "timeframe": timeframe,
+        "cohort": cohort,
+        "total_plays": stat.total_plays if stat else 0,
+        "total_minutes": stat.total_minutes if stat else 0,
+        "unique_listeners": stat.unique_listeners if stat else 0,
+        "unique_artists": stat.unique_artists if stat else 0,
+        "computed_at": stat.computed_at.isoformat() if stat and stat.computed_at else None,
+    }
+
+@app.get("/api/stats/trending/{kind}")
+def get_trending(kind: str, timeframe: str = "week", cohort: str = ALL_USERS, limit: int = 20,
+                 sort: str = "plays", db: Session = Depends(get_db)):
+    """Get trending artists or tracks across all users"""
+    kinds = {"artists": "artist", "tracks": "track"}
+    if kind not in kinds:
+        raise HTTPException(404, "Unknown trending list")
+    if timeframe not in TIMEFRAMES:
+        raise HTTPException(400, f"timeframe must be one of {', '.join(TIMEFRAMES)}")
+    if sort not in ("plays", "growth"):
+        raise HTTPException(400, "sort must be plays or growth")
+
+    items = DBService.get_trending(db, kinds[kind], timeframe, cohort, limit, sort)
+    return {
+        "kind": kind,
+        "timeframe": timeframe,
+        "cohort": cohort,
+        "sort": sort,
+        "items": [
+            {
+                "id": t.item_id,
+                "name": t.item_name,
+                "artist_name": t.artist_name,
+                "play_count": t.play_count,
+                "previous_play_count": t.previous_play_count,
+                "unique_listeners": t.unique_listeners,
+            }
+            for t in items
+        ],
+        "computed_at": items[0].computed_at.isoformat() if items and items[0].computed_at else None,
+    }
+
+@app.post("/api/admin/aggregate-trending")
+def manual_aggregate_trending():
+    """Manually trigger the trending aggregation (for testing)"""
+    from .db.database import get_db_context
+    from .services.trending import aggregator
+    with get_db_context() as db:
+        return aggregator.run(db)
+
+def _recommendation_index():
+    # Loaded lazily so API startup doesn't import numpy/scipy
+    from .services.recommendations import get_index
+    index = get_index()
+    if index is None:
+        raise HTTPException(503, "Recommendation index has not been built yet")
+    return index
+
+@app.get("/api/user/{user_id}/similar-users")
+def get_similar_users(user_id: str, limit: int = 10, db: Session = Depends(get_db)):
+    """Get users with the most similar artist taste"""
+    similar = _recommendation_index().similar_users(user_id, limit)
+    users = DBService.get_users(db, [s["user_id"] for s in similar])
+    return {
+        "user_id": user_id,
+        "similar_users": [
+            {
+                **s,
+                "display_name": users[s["user_id"]].display_name if s["user_id"] in users else None,
+            }
+            for s in similar
+        ],
+    }
+
+@app.get("/api/user/{user_id}/recommended-artists")
+def get_recommended_artists(user_id: str, limit: int = 10):
+    """Get artists that similar users play and this user hasn't"""
+    return {
+        "user_id": user_id,
+        "artists": _recommendation_index().recommend_artists(user_id, limit),
+    }
+
+@app.post("/api/admin/rebuild-recommendations")
+def manual_rebuild_recommendations():
+    """Manually rebuild the recommendation index from scratch"""
+    from .db.database import get_db_context
+    from .services.recommendations import rebuild_index
+    with get_db_context() as db:
+        return rebuild_index(db)
+
+def _require_user(user_id: str):
+    """
+    Sync dependency, so FastAPI runs it in the threadpool. Uses its own session so
+    no connection is held while a long upload is read.
+    """
+    from .db.database import get_db_context
+    with get_db_context() as db:
+        if not DBService.get_user(db, user_id):
+            raise HTTPException(404, "User not found")
+
+@app.post("/api/user/{user_id}/import", dependencies=[Depends(_require_user)])
+async def import_streaming_history(user_id: str, request: Request):
+    """
+    Import a Spotify extended streaming history download (.json or .zip) sent as the raw
+    request body. The upload is queued for the scheduler (the poller process when
+    RUN_SCHEDULER=false); poll the returned job for progress.
+    """
+    from starlette.concurrency import run_in_threadpool
+    from .services import history_import
+    try:
+        path = await history_import.spool_upload(request.stream())
+    except ValueError as e:
+        raise HTTPException(413, str(e))
+
+    try:
+        job = await run_in_threadpool(history_import.create_import_job, user_id, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return job
+
+@app.get("/api/user/{user_id}/import/{job_id}")
+def get_import_status(user_id: str, job_id: str):
+    """Get progress of a streaming history import"""
+    from .services.history_import import get_import_job
+    job = get_import_job(job_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(404, "Import not found")
+    return job
+
 @app.post("/api/admin/poll/{user_id}")
 def manual_poll_user(user_id: str, db: Session = Depends(get_db)):
     """Manually trigger a poll for a specific user (for testing)"""
@@ -133,19 +379,26 @@ def manual_poll_all():
         "results": results
     }
 
+# Plays considered by complete-data
+COMPLETE_DATA_LIMIT = 1000
+
 @app.get("/api/user/{user_id}/complete-data")
 def get_complete_user_data(user_id: str, db: Session = Depends(get_db)):
     """Get all user music data for AI context"""
-    from collections import Counter
-    from datetime import datetime, timedelta
-    
     # Get user info
     user = DBService.get_user(db, user_id)
     if not user:
         return {"error": "User not found"}
     
     # Get all listening history (we'll limit and process it)
-    all_history = DBService.get_user_listening_history(db, user_id, limit=1000)
+    all_history = DBService.get_user_listening_history(db, user_id, limit=COMPLETE_DATA_LIMIT)
+    return _complete_data_payload(user_id, user, all_history)
+
+def _complete_data_payload(user_id: str, user, all_history) -> dict:
+    from collections import Counter
+    
+    if not user:
+        return {"error": "User not found"}
     
     if not all_history:
         return {"error": "No listening history found"}
@@ -242,39 +495,117 @@ def get_complete_user_data(user_id: str, db: Session = Depends(get_db)):
         }
     }
 
-@app.get("/api/user/{user_id}/search")
-def search_user_history(user_id: str, q: str, limit: int = 25, db: Session = Depends(get_db)):
-    """Search user's listening history"""
-    from sqlalchemy import or_
-    from .db.models import ListeningHistory
-
-    history = db.query(ListeningHistory)\
-        .filter(
-            ListeningHistory.user_id == user_id,
-            or_(
-                ListeningHistory.track_name.ilike(f'%{q}%'),
-                ListeningHistory.artist_name.ilike(f'%{q}%')
-            )
-        )\
-        .order_by(ListeningHistory.played_at.desc())\
-        .limit(limit)\
-        .all()
-
+def _search_payload(user_id: str, q: str, history) -> dict:
     return {
         "user_id": user_id,
         "query": q,
-        "matches": [
-            {
-                "track_id": h.track_id,
-                "track_name": h.track_name,
-                "artist_name": h.artist_name,
-                "artist_id": h.artist_id,
-                "album_name": h.album_name,
-                "played_at": h.played_at.isoformat(),
-                "duration_ms": h.duration_ms,
-                "image_url": h.image_url,
-            }
-            for h in history
-        ],
+        "matches": [_track_item(h) for h in history],
         "count": len(history)
-    }
\ No newline at end of file
+    }
+
+@app.get("/api/user/{user_id}/search")
+def search_user_history(user_id: str, q: str, limit: int = 25, db: Session = Depends(get_db)):
+    """Search user's listening history"""
+    history = DBService.search_user_history(db, user_id, q, limit)
+    return _search_payload(user_id, q, history)
+
+BATCH_SECTIONS = ("history", "recent-tracks", "complete-data", "search")
+MAX_BATCH_QUERIES = 20
+MAX_BATCH_LIMIT = 1000
+MAX_BATCH_OFFSET = 10000
+# History pages ending deeper than this run their own OFFSET query instead of widening the shared window
+MAX_SHARED_DEPTH = COMPLETE_DATA_LIMIT
+
+class BatchQuery(BaseModel):
+    section: str
+    user_id: str
+    params: Dict[str, Any] = {}
+
+class BatchRequest(BaseModel):
+    queries: List[BatchQuery]
+
+def _int_param(params: Dict[str, Any], name: str, default: int, maximum: int = MAX_BATCH_LIMIT) -> int:
+    value = int(params.get(name, default))
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    if value > maximum:
+        raise ValueError(f"{name} must be at most {maximum}")
+    return value
+
+def _parse_batch_query(query: BatchQuery):
+    """Returns (args, plays needed from history) for one sub-query"""
+    if query.section not in BATCH_SECTIONS:
+        raise ValueError(f"Unknown section: {query.section}")
+    params = query.params
+    if query.section == "history":
+        args = {"limit": _int_param(params, "limit", 100),
+                "offset": _int_param(params, "offset", 0, MAX_BATCH_OFFSET)}
+        depth = args["limit"] + args["offset"]
+        args["own_query"] = depth > MAX_SHARED_DEPTH
+        return args, 0 if args["own_query"] else depth
+    if query.section == "recent-tracks":
+        args = {"limit": _int_param(params, "limit", 20)}
+        return args, args["limit"]
+    if query.section == "complete-data":
+        return {}, COMPLETE_DATA_LIMIT
+    if not params.get("q"):
+        raise ValueError("q is required")
+    return {"q": str(params["q"]), "limit": _int_param(params, "limit", 25)}, 0
+
+@app.post("/api/batch")
+def batch_query(request: BatchRequest, db: Session = Depends(get_db)):
+    """
+    Run several section queries (for one or more users) over one session.
+    History-based sections share one windowed query per depth and one user lookup.
+    """
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(400, f"At most {MAX_BATCH_QUERIES} queries per batch")
+
+    parsed = []
+    for query in request.queries:
+        try:
+            args, depth = _parse_batch_query(query)
+            parsed.append((query, args, depth, None))
+        except (TypeError, ValueError) as e:
+            parsed.append((query, None, 0, str(e)))
+
+    user_ids = {q.user_id for q, _, _, error in parsed
+                if not error and q.section in ("recent-tracks", "complete-data")}
+    users = DBService.get_users(db, list(user_ids))
+
+    # Deepest history each user needs, then one query per distinct depth
+    depths: Dict[str, int] = {}
+    for query, _, depth, error in parsed:
+        if not error and depth:
+            depths[query.user_id] = max(depths.get(query.user_id, 0), depth)
+    history: Dict[str, list] = {}
+    for depth in set(depths.values()):
+        same_depth = [user_id for user_id, d in depths.items() if d == depth]
+        history.update(DBService.get_listening_history_for_users(db, same_depth, depth))
+
+    results = []
+    for query, args, _, error in parsed:
+        result = {"section": query.section, "user_id": query.user_id}
+        if error:
+            result["error"] = error
+            results.append(result)
+            continue
+
+        user_id = query.user_id
+        plays = history.get(user_id, [])
+        if query.section == "history":
+            if args["own_query"]:
+                page = DBService.get_user_listening_history(db, user_id, args["limit"], args["offset"])
+            else:
+                page = plays[args["offset"]:args["offset"] + args["limit"]]
+            result["data"] = _history_payload(user_id, page, args["limit"], args["offset"])
+        elif query.section == "recent-tracks":
+            result["data"] = _recent_tracks_payload(user_id, users.get(user_id), plays[:args["limit"]])
+        elif query.section == "complete-data":
+            result["data"] = _complete_data_payload(user_id, users.get(user_id), plays[:COMPLETE_DATA_LIMIT])
+        else:
+            matches = DBService.search_user_history(db, user_id, args["q"], args["limit"])
+            result["data"] = _search_payload(user_id, args["q"], matches)
+        results.append(result)
+
+    return {"results": results}
@@ -0,0 +1,54 @@
+"""
+Standalone poller process, so polling never shares a process with the API
+
+    python -m app.poller [--workers N] [--once]
+
+Run the API with RUN_SCHEDULER=false when using this.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import logging
+import os
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from .db.init_db import init_db
+from .scheduler import add_jobs, poll_all_users_job, aggregate_trending_job, update_recommendations_job, run_imports_job
+from .services.ingest_buffer import close_ingest_buffer
+
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll Spotify listening history for all users")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("POLLER_WORKERS", os.cpu_count() or 1)),
+        help="Processes used to poll users in parallel (default: POLLER_WORKERS or CPU count)",
+    )
+    parser.add_argument("--once", action="store_true", help="Poll, aggregate, update recommendations and run queued imports once, then exit")
+    args = parser.parse_args()
+
+    init_db()
+
+    if args.once:
+        poll_all_users_job(args.workers)
+        close_ingest_buffer()
+        aggregate_trending_job()
+        update_recommendations_job()
+        run_imports_job()
+        return
+
+    scheduler = BlockingScheduler()
+    add_jobs(scheduler, workers=args.workers)
+    logger.info(f"Poller started with {args.workers} workers - will poll users every hour")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Poller stopped")
+    finally:
+        close_ingest_buffer()
+
+if __name__ == "__main__":
+    main()
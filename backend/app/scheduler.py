@@ -1,6 +1,10 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from .services.spotify_poller import SpotifyPoller
+from .services.trending import aggregator
+from .services.ingest_buffer import close_ingest_buffer
+from .db.database import get_db_context
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -8,32 +12,115 @@ logger = logging.getLogger(__name__)
 
 scheduler = BackgroundScheduler()
 
-def poll_all_users_job():
+def poll_all_users_job(workers: int = 0):
     """Job that runs every hour to poll all users"""
     logger.info("Starting hourly poll of all users...")
     try:
-        results = SpotifyPoller.poll_all_users()
+        results = SpotifyPoller.poll_all_users(workers)
         successful = sum(1 for r in results if r["success"])
         failed = len(results) - successful
         logger.info(f"Poll complete: {successful} successful, {failed} failed")
     except Exception as e:
         logger.error(f"Error in polling job: {e}")
 
-def start_scheduler():
-    """Start the scheduler with hourly polling"""
+def aggregate_trending_job():
+    """Job that folds new plays into the cross-user trending summaries"""
+    logger.info("Starting trending aggregation...")
+    try:
+        with get_db_context() as db:
+            result = aggregator.run(db)
+        logger.info(f"Trending aggregation complete: {result['ingested']} new plays")
+    except Exception as e:
+        logger.error(f"Error in trending aggregation job: {e}")
+
+def update_recommendations_job():
+    """Job that folds new plays into the similar-users index"""
+    logger.info("Updating recommendation index...")
+    try:
+        # numpy/scipy are only loaded by processes that run this job
+        from .services.recommendations import update_index
+        with get_db_context() as db:
+            result = update_index(db)
+        logger.info(f"Recommendation index updated: {result['users_updated']} users changed")
+    except Exception as e:
+        logger.error(f"Error in recommendation job: {e}")
+
+def rebuild_recommendations_job():
+    """Nightly job that recomputes every neighbour list from scratch"""
+    logger.info("Rebuilding recommendation index...")
+    try:
+        from .services.recommendations import rebuild_index
+        with get_db_context() as db:
+            result = rebuild_index(db)
+        logger.info(f"Recommendation index rebuilt: {result['users']} users")
+    except Exception as e:
+        logger.error(f"Error in recommendation rebuild job: {e}")
+
+def run_imports_job():
+    """Job that runs queued streaming history uploads"""
+    try:
+        from .services.history_import import run_pending_imports
+        count = run_pending_imports()
+        if count:
+            logger.info(f"Ran {count} history imports")
+    except Exception as e:
+        logger.error(f"Error in history import job: {e}")
+
+def add_jobs(target, workers: int = 0):
+    """Register the polling and aggregation jobs on a scheduler"""
     # Run every hour at minute 0
-    scheduler.add_job(
+    target.add_job(
         poll_all_users_job,
         CronTrigger(minute=0),
+        kwargs={"workers": workers},
         id='poll_listening_history',
         name='Poll Spotify listening history',
         replace_existing=True
     )
-    
+    # Aggregate shortly after each poll has landed new plays
+    target.add_job(
+        aggregate_trending_job,
+        CronTrigger(minute=15),
+        id='aggregate_trending',
+        name='Aggregate global trending stats',
+        replace_existing=True
+    )
+    target.add_job(
+        update_recommendations_job,
+        CronTrigger(minute=20),
+        id='update_recommendations',
+        name='Update similar-users index',
+        replace_existing=True
+    )
+    # Uploads are picked up here rather than in the API request's process
+    target.add_job(
+        run_imports_job,
+        IntervalTrigger(seconds=30),
+        id='run_history_imports',
+        name='Run queued history imports',
+        coalesce=True,
+        replace_existing=True
+    )
+    # Incremental updates only touch users with new plays, so refresh everyone nightly
+    target.add_job(
+        rebuild_recommendations_job,
+        CronTrigger(hour=4, minute=30),
+        id='rebuild_recommendations',
+        name='Rebuild similar-users index',
+        replace_existing=True
+    )
+
+def start_scheduler():
+    """Start the in-process scheduler with hourly polling"""
+    add_jobs(scheduler)
     scheduler.start()
     logger.info("Scheduler started - will poll users every hour")
 
 def stop_scheduler():
     """Stop the scheduler gracefully"""
+    if not scheduler.running:
+        return
     scheduler.shutdown()
+    # Write any plays still buffered by an interrupted poll
+    close_ingest_buffer()
     logger.info("Scheduler stopped")
\ No newline at end of file
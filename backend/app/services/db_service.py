@@ -1,8 +1,30 @@
+from sqlalchemy import func, or_, update, bindparam
 from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo
 from typing import Optional, Dict, Any, List
-from ..db.models import User, ListeningHistory
+from ..db.models import User, ListeningHistory, TrendingStat, GlobalStat
+
+SERIES_BUCKETS = ("day", "week", "month")
+# Longest a transaction writing listening_history is expected to stay open
+WRITE_TRANSACTION_LIMIT = timedelta(minutes=5)
+
+def _bucket_start(d: date, bucket: str) -> date:
+    """First day of the day/week (Monday)/month bucket containing d"""
+    if bucket == "week":
+        return d - timedelta(days=d.weekday())
+    if bucket == "month":
+        return d.replace(day=1)
+    return d
+
+def _next_bucket(d: date, bucket: str) -> date:
+    """First day of the bucket following the one starting at d"""
+    if bucket == "week":
+        return d + timedelta(days=7)
+    if bucket == "month":
+        return (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return d + timedelta(days=1)
 
 class DBService:
     @staticmethod
@@ -42,40 +64,123 @@ class DBService:
             user.updated_at = datetime.utcnow()
             db.commit()
     
+    @staticmethod
+    def history_row(user_id: str, track_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Map a parsed track onto listening_history columns"""
+        return {
+            "user_id": user_id,
+            "track_id": track_data.get('track_id'),
+            "track_name": track_data.get('track_name'),
+            "artist_name": track_data.get('artist_name'),
+            "artist_id": track_data.get('artist_id'),
+            "album_name": track_data.get('album_name'),
+            "played_at": track_data.get('played_at'),
+            "duration_ms": track_data.get('duration_ms'),
+            "image_url": track_data.get('image_url'),
+        }
+    
+    @staticmethod
+    def insert_listening_rows(db: Session, rows: List[Dict[str, Any]], per_row: bool = False) -> Dict[str, int]:
+        """
+        Insert listening_history rows in multi-row statements, skipping duplicates
+        per_row inserts each row in its own savepoint instead, so a bad row is skipped
+        rather than failing the batch
+        Returns number of new rows per user_id (caller commits)
+        """
+        counts: Dict[str, int] = {}
+        # Local files and podcasts come back without a track id
+        rows = [r for r in rows if r.get("track_id") and r.get("played_at")]
+        if not rows:
+            return counts
+        
+        dialect = db.bind.dialect.name
+        if dialect in ("postgresql", "sqlite") and not per_row:
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(ListeningHistory)\
+                .on_conflict_do_nothing(index_elements=["user_id", "track_id", "played_at"])\
+                .returning(ListeningHistory.user_id)
+            for (user_id,) in db.execute(stmt, rows):
+                counts[user_id] = counts.get(user_id, 0) + 1
+        else:
+            # One savepoint per row so duplicates and bad rows don't abort the batch
+            for row in rows:
+                try:
+                    with db.begin_nested():
+                        db.add(ListeningHistory(**row))
+                    counts[row["user_id"]] = counts.get(row["user_id"], 0) + 1
+                except IntegrityError:
+                    # Track already exists (duplicate), skip it
+                    continue
+                except SQLAlchemyError as e:
+                    print(f"Skipping track {row['track_id']} for {row['user_id']}: {e}")
+                    continue
+        
+        # Same transaction as the inserts, so readers never see rows without the new version
+        DBService.bump_data_versions(db, [user_id for user_id, n in counts.items() if n])
+        return counts
+    
+    @staticmethod
+    def bump_data_versions(db: Session, user_ids: List[str]):
+        """Increment data_version and stamp last_ingest_at for users whose history changed"""
+        if not user_ids:
+            return
+        users = User.__table__
+        stmt = update(users)\
+            .where(users.c.user_id == bindparam("b_user_id"))\
+            .values(data_version=users.c.data_version + 1, last_ingest_at=bindparam("b_now"))
+        now = datetime.now(timezone.utc)
+        db.execute(stmt, [{"b_user_id": user_id, "b_now": now} for user_id in user_ids])
+    
+    @staticmethod
+    def get_settled_history_id(db: Session) -> int:
+        """
+        Highest listening_history id an incremental reader can checkpoint at.
+        Ids are handed out at insert, not commit, so a transaction still in flight
+        can hold lower ids than rows already visible. created_at is the inserting
+        transaction's start time, so once a row's transaction started more than
+        twice WRITE_TRANSACTION_LIMIT ago, every lower id has been committed.
+        """
+        cutoff = db.query(func.now()).scalar() - 2 * WRITE_TRANSACTION_LIMIT
+        # Walks the primary key backwards from the newest rows
+        return db.query(ListeningHistory.id)\
+            .filter(ListeningHistory.created_at < cutoff)\
+            .order_by(ListeningHistory.id.desc())\
+            .limit(1)\
+            .scalar() or 0
+    
+    @staticmethod
+    def get_data_version(db: Session, user_id: str):
+        """(data_version, last_ingest_at) for a user without loading the row, or None"""
+        return db.query(User.data_version, User.last_ingest_at)\
+            .filter(User.user_id == user_id)\
+            .first()
+    
     @staticmethod
     def save_listening_history(db: Session, user_id: str, tracks_data: List[Dict[str, Any]]) -> int:
         """
         Save listening history tracks for a user
         Returns number of new tracks saved
         """
-        saved_count = 0
-        
-        for track_data in tracks_data:
+        rows = [DBService.history_row(user_id, t) for t in tracks_data]
+        try:
+            counts = DBService.insert_listening_rows(db, rows)
+            db.commit()
+        except Exception as e:
+            # Retry row by row so one bad track doesn't drop the whole poll
+            print(f"Error saving tracks for {user_id}, retrying row by row: {e}")
+            db.rollback()
             try:
-                history = ListeningHistory(
-                    user_id=user_id,
-                    track_id=track_data['track_id'],
-                    track_name=track_data.get('track_name'),
-                    artist_name=track_data.get('artist_name'),
-                    artist_id=track_data.get('artist_id'),
-                    album_name=track_data.get('album_name'),
-                    played_at=track_data['played_at'],
-                    duration_ms=track_data.get('duration_ms'),
-                    image_url=track_data.get('image_url')
-                )
-                db.add(history)
+                counts = DBService.insert_listening_rows(db, rows, per_row=True)
                 db.commit()
-                saved_count += 1
-            except IntegrityError:
-                # Track already exists (duplicate), skip it
-                db.rollback()
-                continue
             except Exception as e:
-                print(f"Error saving track {track_data.get('track_id')}: {e}")
+                print(f"Error saving tracks for {user_id}: {e}")
                 db.rollback()
-                continue
+                return 0
         
-        return saved_count
+        return counts.get(user_id, 0)
     
     @staticmethod
     def get_user_listening_history(db: Session, user_id: str, limit: int = 100, offset: int = 0):
@@ -87,9 +192,163 @@ class DBService:
             .offset(offset)\
             .all()
     
+    @staticmethod
+    def get_users(db: Session, user_ids: List[str]) -> Dict[str, User]:
+        """Get several users in one query, keyed by ID"""
+        if not user_ids:
+            return {}
+        users = db.query(User).filter(User.user_id.in_(user_ids)).all()
+        return {user.user_id: user for user in users}
+    
+    @staticmethod
+    def get_listening_history_for_users(db: Session, user_ids: List[str],
+                                        limit: int = 100) -> Dict[str, List[ListeningHistory]]:
+        """
+        Get the latest `limit` plays of several users in one query
+        Returns plays per user_id, newest first
+        """
+        history: Dict[str, List[ListeningHistory]] = {user_id: [] for user_id in user_ids}
+        if not user_ids:
+            return history
+        
+        row_number = func.row_number().over(
+            partition_by=ListeningHistory.user_id,
+            order_by=ListeningHistory.played_at.desc(),
+        ).label("row_number")
+        ranked = db.query(ListeningHistory.id.label("id"), row_number)\
+            .filter(ListeningHistory.user_id.in_(user_ids))\
+            .subquery()
+        rows = db.query(ListeningHistory)\
+            .join(ranked, ListeningHistory.id == ranked.c.id)\
+            .filter(ranked.c.row_number <= limit)\
+            .order_by(ListeningHistory.user_id, ListeningHistory.played_at.desc())\
+            .all()
+        for h in rows:
+            history[h.user_id].append(h)
+        return history
+    
+    @staticmethod
+    def search_user_history(db: Session, user_id: str, q: str, limit: int = 25) -> List[ListeningHistory]:
+        """Search a user's history by track or artist name"""
+        return db.query(ListeningHistory)\
+            .filter(
+                ListeningHistory.user_id == user_id,
+                or_(
+                    ListeningHistory.track_name.ilike(f'%{q}%'),
+                    ListeningHistory.artist_name.ilike(f'%{q}%')
+                )
+            )\
+            .order_by(ListeningHistory.played_at.desc())\
+            .limit(limit)\
+            .all()
+    
+    @staticmethod
+    def get_play_times(db: Session, user_id: str, track_ids: List[str],
+                       start: datetime, end: datetime) -> Dict[str, List[datetime]]:
+        """played_at values (UTC, sorted) per track for a user's plays between start and end"""
+        rows = db.query(ListeningHistory.track_id, ListeningHistory.played_at)\
+            .filter(
+                ListeningHistory.user_id == user_id,
+                ListeningHistory.track_id.in_(track_ids),
+                ListeningHistory.played_at >= start,
+                ListeningHistory.played_at <= end
+            )\
+            .order_by(ListeningHistory.played_at)\
+            .all()
+        
+        times: Dict[str, List[datetime]] = {}
+        for track_id, played_at in rows:
+            if played_at.tzinfo is None:
+                # If naive, assume UTC
+                played_at = played_at.replace(tzinfo=timezone.utc)
+            times.setdefault(track_id, []).append(played_at)
+        return times
+    
     @staticmethod
     def get_all_active_users(db: Session) -> List[User]:
         """Get all users who have valid tokens for polling"""
         return db.query(User)\
             .filter(User.refresh_token.isnot(None))\
-            .all()
\ No newline at end of file
+            .all()
+    
+    @staticmethod
+    def get_listening_series(db: Session, user_id: str, start_date: date, end_date: date,
+                             bucket: str = "day", tz: str = "UTC",
+                             artist_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Get minutes and plays per day/week/month between start_date and end_date
+        (inclusive, in the user's timezone). Empty buckets are returned as zeros.
+        """
+        zone = ZoneInfo(tz)
+        range_start = datetime.combine(start_date, datetime.min.time(), tzinfo=zone)
+        range_end = datetime.combine(end_date + timedelta(days=1), datetime.min.time(), tzinfo=zone)
+
+        filters = [
+            ListeningHistory.user_id == user_id,
+            ListeningHistory.played_at >= range_start.astimezone(timezone.utc),
+            ListeningHistory.played_at < range_end.astimezone(timezone.utc),
+        ]
+        if artist_id:
+            filters.append(ListeningHistory.artist_id == artist_id)
+
+        totals: Dict[date, List[int]] = {}
+        if db.bind.dialect.name == "postgresql":
+            # Bucket in SQL so only one row per period leaves the database
+            period = func.date_trunc(bucket, func.timezone(tz, ListeningHistory.played_at))
+            rows = db.query(
+                period.label("period"),
+                func.count(ListeningHistory.id),
+                func.coalesce(func.sum(ListeningHistory.duration_ms), 0),
+            ).filter(*filters).group_by(period).all()
+            for period_start, plays, duration_ms in rows:
+                totals[period_start.date()] = [int(plays), int(duration_ms)]
+        else:
+            # Other databases lack timezone-aware date_trunc, so bucket the two columns we need here
+            rows = db.query(ListeningHistory.played_at, ListeningHistory.duration_ms)\
+                .filter(*filters)\
+                .yield_per(1000)
+            for played_at, duration_ms in rows:
+                if played_at.tzinfo is None:
+                    # If naive, assume UTC
+                    played_at = played_at.replace(tzinfo=timezone.utc)
+                key = _bucket_start(played_at.astimezone(zone).date(), bucket)
+                entry = totals.setdefault(key, [0, 0])
+                entry[0] += 1
+                entry[1] += duration_ms or 0
+
+        series = []
+        current = _bucket_start(start_date, bucket)
+        while current <= end_date:
+            plays, duration_ms = totals.get(current, (0, 0))
+            series.append({
+                "period": current.isoformat(),
+                "minutes": round(duration_ms / (1000 * 60), 1),
+                "plays": plays,
+            })
+            current = _next_bucket(current, bucket)
+        return series
+    
+    @staticmethod
+    def get_global_stats(db: Session, timeframe: str, cohort: str) -> Optional[GlobalStat]:
+        """Get precomputed cross-user totals"""
+        return db.query(GlobalStat)\
+            .filter(GlobalStat.cohort == cohort, GlobalStat.timeframe == timeframe)\
+            .first()
+    
+    @staticmethod
+    def get_trending(db: Session, kind: str, timeframe: str, cohort: str,
+                     limit: int = 20, sort: str = "plays") -> List[TrendingStat]:
+        """Get precomputed top artists/tracks, by plays or by growth over the previous window"""
+        if sort == "growth":
+            order = (TrendingStat.play_count - TrendingStat.previous_play_count).desc()
+        else:
+            order = TrendingStat.rank
+        return db.query(TrendingStat)\
+            .filter(
+                TrendingStat.kind == kind,
+                TrendingStat.timeframe == timeframe,
+                TrendingStat.cohort == cohort,
+            )\
+            .order_by(order)\
+            .limit(limit)\
+            .all()
@@ -0,0 +1,284 @@
+import bisect
+import datetime
+import fnmatch
+import io
+import json
+import os
+import tempfile
+import uuid
+import zipfile
+from typing import Optional, Dict, Any, List, Iterator, Callable, IO
+from ..db.database import get_db_context
+from ..db.models import ImportJob
+from .db_service import DBService
+
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "10000"))
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(2 * 1024 ** 3)))
+# Spotify only counts a stream as a play after 30 seconds
+MIN_PLAY_MS = 30000
+# A single history entry is a few hundred bytes; anything this big is a broken file
+MAX_ITEM_CHARS = 1 << 20
+# Archive timestamps are whole seconds while polled plays keep milliseconds,
+# so a play already polled is matched within this tolerance
+DUPLICATE_TOLERANCE = datetime.timedelta(seconds=1)
+# Members of a .zip download that hold audio history
+AUDIO_HISTORY_PATTERN = "Streaming_History_Audio_*.json"
+
+def iter_json_array(stream: IO[str], chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yield the items of a top-level JSON array while holding only a chunk or two in memory"""
+    decoder = json.JSONDecoder()
+    buffer, pos = stream.read(chunk_size), 0
+    eof = not buffer
+    started = False
+
+    while True:
+        # Skip whitespace and separators, refilling as needed
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            buffer, pos = stream.read(chunk_size), 0
+            eof = not buffer
+        if pos >= len(buffer):
+            raise ValueError("Unexpected end of file" if started else "Expected a JSON array")
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # A number is only complete once a delimiter follows it ("2." may be "2.5")
+            complete = (eof or isinstance(item, (dict, list, str))
+                        or (end < len(buffer) and buffer[end] in " \t\r\n,]"))
+        except json.JSONDecodeError:
+            if eof or len(buffer) - pos > MAX_ITEM_CHARS:
+                raise
+            complete = False
+        if not complete:
+            more = stream.read(chunk_size)
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+
+        yield item
+        pos = end
+        if pos >= chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+def parse_history_entry(entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Map one extended streaming history entry onto our track format; None for podcasts and skips"""
+    uri = entry.get("spotify_track_uri")
+    ts = entry.get("ts")
+    if not uri or not ts or not uri.startswith("spotify:track:"):
+        return None
+    ms_played = entry.get("ms_played") or 0
+    if ms_played < MIN_PLAY_MS:
+        return None
+
+    return {
+        "track_id": uri.rsplit(":", 1)[1],
+        "track_name": entry.get("master_metadata_track_name"),
+        "artist_name": entry.get("master_metadata_album_artist_name"),
+        "artist_id": None,  # archives only carry the artist name
+        "album_name": entry.get("master_metadata_album_album_name"),
+        "played_at": datetime.datetime.fromisoformat(ts.replace("Z", "+00:00")),
+        # Time actually listened; polled plays store the track's full length instead
+        "duration_ms": ms_played,
+        "image_url": None,
+    }
+
+def iter_archive_entries(path: str) -> Iterator[Dict[str, Any]]:
+    """Entries from a .json history file or every audio history JSON inside a .zip download"""
+    with open(path, "rb") as f:
+        is_zip = f.read(4) == b"PK\x03\x04"
+
+    if not is_zip:
+        with open(path, encoding="utf-8-sig") as f:
+            yield from iter_json_array(f)
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        for name in sorted(archive.namelist()):
+            # Account data downloads also hold Userdata.json etc., and video history
+            # has the same shape but isn't listening data
+            if not fnmatch.fnmatch(os.path.basename(name), AUDIO_HISTORY_PATTERN):
+                continue
+            with archive.open(name) as member:
+                yield from iter_json_array(io.TextIOWrapper(member, encoding="utf-8-sig"))
+
+def _drop_polled_duplicates(db, user_id: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rows without an existing play of the same track within DUPLICATE_TOLERANCE"""
+    start = min(row["played_at"] for row in rows) - DUPLICATE_TOLERANCE
+    end = max(row["played_at"] for row in rows) + DUPLICATE_TOLERANCE
+    existing = DBService.get_play_times(db, user_id, list({row["track_id"] for row in rows}), start, end)
+
+    kept = []
+    for row in rows:
+        times = existing.get(row["track_id"])
+        if times:
+            i = bisect.bisect_left(times, row["played_at"] - DUPLICATE_TOLERANCE)
+            if i < len(times) and times[i] <= row["played_at"] + DUPLICATE_TOLERANCE:
+                continue
+        kept.append(row)
+    return kept
+
+def import_history_file(user_id: str, path: str, batch_rows: int = IMPORT_BATCH_ROWS,
+                        progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+    """
+    Stream-import an extended streaming history file for a user.
+    Rows are written in batches of batch_rows, each in its own transaction.
+    Plays already stored (by an earlier import or by the poller, within
+    DUPLICATE_TOLERANCE) are counted as duplicates and skipped.
+    """
+    stats = {"entries": 0, "skipped": 0, "imported": 0, "duplicates": 0}
+    batch = []
+
+    def flush():
+        with get_db_context() as db:
+            rows = _drop_polled_duplicates(db, user_id, batch)
+            saved = DBService.insert_listening_rows(db, rows).get(user_id, 0)
+        stats["imported"] += saved
+        stats["duplicates"] += len(batch) - saved
+        batch.clear()
+        if progress:
+            progress(dict(stats))
+
+    for entry in iter_archive_entries(path):
+        stats["entries"] += 1
+        track = parse_history_entry(entry) if isinstance(entry, dict) else None
+        if track is None:
+            stats["skipped"] += 1
+            continue
+        batch.append(DBService.history_row(user_id, track))
+        if len(batch) >= batch_rows:
+            flush()
+    if batch:
+        flush()
+    return stats
+
+# Uploads wait here for the process running the scheduler; share it when the poller runs elsewhere
+IMPORT_UPLOAD_DIR = os.getenv("IMPORT_UPLOAD_DIR") or tempfile.gettempdir()
+# Finished jobs are kept this long for clients to read their result
+JOB_RETENTION = datetime.timedelta(days=7)
+# Progress is written every batch; a running job silent this long lost its worker
+STALE_JOB = datetime.timedelta(minutes=15)
+JOB_STATS = ("entries", "skipped", "imported", "duplicates")
+
+async def spool_upload(chunks) -> str:
+    """Write a streamed request body to IMPORT_UPLOAD_DIR without blocking the event loop; returns its path"""
+    from starlette.concurrency import run_in_threadpool
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="spotify-history-", dir=IMPORT_UPLOAD_DIR)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_IMPORT_BYTES:
+                    raise ValueError(f"Upload larger than {MAX_IMPORT_BYTES} bytes")
+                await run_in_threadpool(f.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+def _remove_upload(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _job_payload(job: ImportJob) -> Dict[str, Any]:
+    return {
+        "job_id": job.job_id,
+        "user_id": job.user_id,
+        "status": job.status,
+        "stats": {name: getattr(job, name) for name in JOB_STATS},
+        "error": job.error,
+    }
+
+def create_import_job(user_id: str, path: str) -> Dict[str, Any]:
+    """Queue a spooled upload for the scheduler, pruning finished jobs past JOB_RETENTION"""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - JOB_RETENTION
+    with get_db_context() as db:
+        db.query(ImportJob)\
+            .filter(ImportJob.status.in_(["done", "failed"]), ImportJob.updated_at < cutoff)\
+            .delete(synchronize_session=False)
+        job = ImportJob(job_id=uuid.uuid4().hex, user_id=user_id, status="queued", path=path,
+                        **{name: 0 for name in JOB_STATS})
+        db.add(job)
+        db.flush()
+        return _job_payload(job)
+
+def get_import_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with get_db_context() as db:
+        job = db.query(ImportJob).filter(ImportJob.job_id == job_id).first()
+        return _job_payload(job) if job else None
+
+def _update_import_job(job_id: str, **fields):
+    with get_db_context() as db:
+        db.query(ImportJob).filter(ImportJob.job_id == job_id).update(fields, synchronize_session=False)
+
+def fail_stale_import_jobs() -> int:
+    """Mark running jobs whose worker died as failed and drop their uploads"""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - STALE_JOB
+    with get_db_context() as db:
+        stale = db.query(ImportJob.job_id, ImportJob.path)\
+            .filter(ImportJob.status == "running", ImportJob.updated_at < cutoff)\
+            .all()
+        for job_id, _ in stale:
+            db.query(ImportJob)\
+                .filter(ImportJob.job_id == job_id, ImportJob.status == "running")\
+                .update({"status": "failed", "error": "Import was interrupted"}, synchronize_session=False)
+    for _, path in stale:
+        if path:
+            _remove_upload(path)
+    return len(stale)
+
+def _claim_import_job() -> Optional[ImportJob]:
+    """Move the oldest queued job to running; only one process can claim each job"""
+    with get_db_context() as db:
+        while True:
+            job = db.query(ImportJob)\
+                .filter(ImportJob.status == "queued")\
+                .order_by(ImportJob.created_at)\
+                .first()
+            if job is None:
+                return None
+            claimed = db.query(ImportJob)\
+                .filter(ImportJob.job_id == job.job_id, ImportJob.status == "queued")\
+                .update({"status": "running"}, synchronize_session=False)
+            if claimed:
+                db.expunge(job)
+                return job
+            # Another process claimed it first
+            db.expire(job)
+
+def run_import_job(job_id: str, user_id: str, path: str):
+    """Import a claimed job's upload, recording progress on the job"""
+    try:
+        stats = import_history_file(user_id, path,
+                                    progress=lambda stats: _update_import_job(job_id, **stats))
+        _update_import_job(job_id, status="done", **stats)
+    except Exception as e:
+        print(f"Error importing history for job {job_id}: {e}")
+        _update_import_job(job_id, status="failed", error=str(e))
+    finally:
+        _remove_upload(path)
+
+def run_pending_imports() -> int:
+    """Run queued imports one after another; returns how many ran"""
+    fail_stale_import_jobs()
+    count = 0
+    while True:
+        job = _claim_import_job()
+        if job is None:
+            return count
+        run_import_job(job.job_id, job.user_id, job.path)
+        count += 1
@@ -0,0 +1,130 @@
+import os
+import threading
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, List, Tuple
+from ..db.database import get_db_context
+from .db_service import DBService
+
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "5000"))
+INGEST_FLUSH_SECONDS = float(os.getenv("INGEST_FLUSH_SECONDS", "2"))
+INGEST_MAX_PENDING_ROWS = int(os.getenv("INGEST_MAX_PENDING_ROWS", "50000"))
+
+class IngestBuffer:
+    """
+    Write-behind buffer between the poller and the database.
+    Plays from many users are queued and written in one transaction once
+    batch_rows are pending or flush_seconds have passed. If that transaction
+    fails, each submit is retried on its own. Each submit returns a Future
+    resolved with that user's number of new rows.
+    """
+
+    def __init__(self, batch_rows: int = INGEST_BATCH_ROWS, flush_seconds: float = INGEST_FLUSH_SECONDS,
+                 max_pending_rows: int = INGEST_MAX_PENDING_ROWS):
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.max_pending_rows = max(max_pending_rows, batch_rows)
+        self._pending: List[Tuple[str, List[Dict[str, Any]], Future]] = []
+        self._pending_rows = 0
+        self._flush_requested = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id: str, tracks: List[Dict[str, Any]]) -> Future:
+        """Queue a user's parsed plays; blocks while the buffer is full"""
+        future = Future()
+        rows = [DBService.history_row(user_id, t) for t in tracks]
+        with self._cond:
+            # Backpressure: wait for the writer instead of growing without bound
+            while self._pending_rows >= self.max_pending_rows and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Ingest buffer is closed")
+            self._pending.append((user_id, rows, future))
+            self._pending_rows += len(rows)
+            if self._pending_rows >= self.batch_rows:
+                self._cond.notify_all()
+        return future
+
+    def flush(self):
+        """Write everything queued so far and wait for it to land"""
+        with self._cond:
+            futures = [future for _, _, future in self._pending]
+            self._flush_requested = True
+            self._cond.notify_all()
+        for future in futures:
+            future.exception()  # wait without raising
+
+    def close(self):
+        """Flush remaining plays and stop the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending_rows >= self.batch_rows or self._flush_requested or self._closed,
+                    timeout=self.flush_seconds,
+                )
+                batch = self._pending
+                self._pending = []
+                self._pending_rows = 0
+                self._flush_requested = False
+                closed = self._closed
+                self._cond.notify_all()
+            if batch:
+                self._write(batch)
+            elif closed:
+                return
+
+    def _write(self, batch: List[Tuple[str, List[Dict[str, Any]], Future]]):
+        try:
+            with get_db_context() as db:
+                counts = DBService.insert_listening_rows(db, [row for _, rows, _ in batch for row in rows])
+        except Exception as e:
+            print(f"Error writing {len(batch)} buffered polls, retrying each on its own: {e}")
+            self._write_each(batch)
+            return
+
+        # A user polled twice before a flush shares one count across both submits
+        for user_id, rows, future in batch:
+            saved = min(counts.get(user_id, 0), len(rows))
+            counts[user_id] = counts.get(user_id, 0) - saved
+            future.set_result(saved)
+
+    def _write_each(self, batch: List[Tuple[str, List[Dict[str, Any]], Future]]):
+        """One transaction per submit, so a bad row only fails the user it belongs to"""
+        for user_id, rows, future in batch:
+            try:
+                with get_db_context() as db:
+                    saved = DBService.insert_listening_rows(db, rows).get(user_id, 0)
+            except Exception as e:
+                print(f"Error writing buffered poll for {user_id}: {e}")
+                future.set_exception(e)
+                continue
+            future.set_result(saved)
+
+_buffer: Optional[IngestBuffer] = None
+_buffer_pid: Optional[int] = None
+_buffer_lock = threading.Lock()
+
+def get_ingest_buffer() -> IngestBuffer:
+    """Process-wide buffer, recreated in forked pool workers"""
+    global _buffer, _buffer_pid
+    with _buffer_lock:
+        if _buffer is None or _buffer_pid != os.getpid():
+            _buffer = IngestBuffer()
+            _buffer_pid = os.getpid()
+        return _buffer
+
+def close_ingest_buffer():
+    """Flush and stop this process's buffer, if one was started"""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is not None and _buffer_pid == os.getpid():
+            _buffer.close()
+        _buffer = None
@@ -0,0 +1,338 @@
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from ..db.models import ListeningHistory
+from .db_service import DBService
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+INDEX_DIR = os.getenv("RECOMMENDER_INDEX_DIR", "recommender_index")
+# Neighbours kept per user
+NEIGHBOURS = 20
+# Cap on the dense similarity block computed at once (floats)
+BLOCK_FLOATS = 1 << 24
+# Attempts to load when a concurrent save prunes the version being read
+LOAD_ATTEMPTS = 3
+
+@contextmanager
+def _index_file_lock(path: str):
+    """Exclusive lock on the index directory, so only one process builds and saves at a time"""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".lock"), "w") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _normalize(counts: sparse.csr_matrix) -> sparse.csr_matrix:
+    """log-scale play counts and L2-normalize each user row, so dot products are cosine similarity"""
+    weighted = counts.astype(np.float32, copy=True)
+    weighted.data = np.log1p(weighted.data)
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ weighted)
+
+def _top_neighbours(normalized: sparse.csr_matrix, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact cosine top-NEIGHBOURS for the given user rows, computed in bounded blocks"""
+    n_users = normalized.shape[0]
+    k = min(NEIGHBOURS, max(n_users - 1, 0))
+    neighbours = np.full((len(rows), NEIGHBOURS), -1, dtype=np.int32)
+    scores = np.zeros((len(rows), NEIGHBOURS), dtype=np.float32)
+    if k == 0:
+        return neighbours, scores
+
+    block = max(1, BLOCK_FLOATS // n_users)
+    transposed = normalized.T.tocsc()
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start + block]
+        similarity = (normalized[chunk] @ transposed).toarray()
+        similarity[np.arange(len(chunk)), chunk] = -1  # never your own neighbour
+        top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarity, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        # Users with nothing in common are not neighbours
+        top[top_scores <= 0] = -1
+        top_scores[top_scores <= 0] = 0
+        neighbours[start:start + len(chunk), :k] = top
+        scores[start:start + len(chunk), :k] = top_scores
+    return neighbours, scores
+
+class SimilarityIndex:
+    """
+    Sparse user x artist play counts with precomputed nearest-neighbour users.
+    Requests only read NEIGHBOURS rows, so nothing pairwise is computed per request.
+    """
+
+    def __init__(self, user_ids: List[str], artist_ids: List[str], artist_names: List[Optional[str]],
+                 counts: sparse.csr_matrix, neighbours: np.ndarray, scores: np.ndarray, last_id: int):
+        self.user_ids = user_ids
+        self.artist_ids = artist_ids
+        self.artist_names = artist_names
+        self.counts = counts
+        self.neighbours = neighbours
+        self.scores = scores
+        self.last_id = last_id
+        self.user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+        self.artist_index = {artist_id: i for i, artist_id in enumerate(artist_ids)}
+
+    @staticmethod
+    def _play_counts(db: Session, after_id: int):
+        """
+        (user_id, artist_id, artist_name, plays) for rows after after_id, plus the id read up to.
+        Stops at the settled id, so rows still being committed with lower ids are
+        picked up by the next update rather than skipped.
+        """
+        last_id = DBService.get_settled_history_id(db)
+        rows = db.query(
+            ListeningHistory.user_id,
+            ListeningHistory.artist_id,
+            func.max(ListeningHistory.artist_name),
+            func.count(ListeningHistory.id),
+        ).filter(
+            ListeningHistory.id > after_id,
+            ListeningHistory.id <= last_id,
+            ListeningHistory.artist_id.isnot(None),
+        ).group_by(ListeningHistory.user_id, ListeningHistory.artist_id).all()
+        return rows, last_id
+
+    @classmethod
+    def build(cls, db: Session) -> "SimilarityIndex":
+        """Build the whole index from listening_history"""
+        index = cls([], [], [], sparse.csr_matrix((0, 0), dtype=np.float32),
+                    np.zeros((0, NEIGHBOURS), dtype=np.int32), np.zeros((0, NEIGHBOURS), dtype=np.float32), 0)
+        index.update(db, full=True)
+        return index
+
+    def update(self, db: Session, full: bool = False) -> int:
+        """Fold plays added since the last update into the index; returns users affected"""
+        rows, last_id = self._play_counts(db, self.last_id)
+        self.last_id = max(self.last_id, last_id)
+        if not rows:
+            return 0
+
+        user_rows, artist_cols, plays = [], [], []
+        for user_id, artist_id, artist_name, count in rows:
+            if user_id not in self.user_index:
+                self.user_index[user_id] = len(self.user_ids)
+                self.user_ids.append(user_id)
+            if artist_id not in self.artist_index:
+                self.artist_index[artist_id] = len(self.artist_ids)
+                self.artist_ids.append(artist_id)
+                self.artist_names.append(artist_name)
+            user_rows.append(self.user_index[user_id])
+            artist_cols.append(self.artist_index[artist_id])
+            plays.append(count)
+
+        shape = (len(self.user_ids), len(self.artist_ids))
+        delta = sparse.csr_matrix((np.array(plays, dtype=np.float32), (user_rows, artist_cols)), shape=shape)
+        counts = self.counts.copy()
+        counts.resize(shape)
+        self.counts = sparse.csr_matrix(counts + delta)
+
+        # Mapped arrays from disk are read-only; grow into fresh copies
+        neighbours = np.full((shape[0], NEIGHBOURS), -1, dtype=np.int32)
+        scores = np.zeros((shape[0], NEIGHBOURS), dtype=np.float32)
+        neighbours[:len(self.neighbours)] = self.neighbours
+        scores[:len(self.scores)] = self.scores
+
+        normalized = _normalize(self.counts)
+        affected = np.arange(shape[0]) if full else np.unique(np.array(user_rows, dtype=np.int32))
+        new_neighbours, new_scores = _top_neighbours(normalized, affected)
+        neighbours[affected] = new_neighbours
+        scores[affected] = new_scores
+
+        if not full:
+            # Let changed users also enter (or move within) the lists of their neighbours
+            for row, row_neighbours, row_scores in zip(affected, new_neighbours, new_scores):
+                for other, score in zip(row_neighbours, row_scores):
+                    if other < 0:
+                        break
+                    listed = np.where(neighbours[other] == row)[0]
+                    if len(listed):
+                        slot = listed[0]
+                    else:
+                        slot = int(np.argmin(scores[other]))
+                        if scores[other, slot] >= score and neighbours[other, slot] >= 0:
+                            continue
+                    neighbours[other, slot] = row
+                    scores[other, slot] = score
+                    order = np.argsort(-scores[other])
+                    neighbours[other] = neighbours[other, order]
+                    scores[other] = scores[other, order]
+
+        self.neighbours = neighbours
+        self.scores = scores
+        return len(affected)
+
+    def similar_users(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        row = self.user_index.get(user_id)
+        if row is None:
+            return []
+        return [
+            {"user_id": self.user_ids[other], "similarity": round(float(score), 4)}
+            for other, score in zip(self.neighbours[row][:limit], self.scores[row][:limit])
+            if other >= 0
+        ]
+
+    def recommend_artists(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Artists neighbours play that this user doesn't, weighted by neighbour similarity"""
+        row = self.user_index.get(user_id)
+        if row is None:
+            return []
+        valid = self.neighbours[row] >= 0
+        others = self.neighbours[row][valid]
+        if not len(others):
+            return []
+
+        scores = np.asarray(_normalize(self.counts[others]).T @ self.scores[row][valid]).ravel()
+        scores[self.counts[row].indices] = 0  # already listening
+        top = np.argsort(-scores)[:limit]
+        return [
+            {
+                "artist_id": self.artist_ids[col],
+                "artist_name": self.artist_names[col],
+                "score": round(float(scores[col]), 4),
+            }
+            for col in top
+            if scores[col] > 0
+        ]
+
+    def save(self, path: str = INDEX_DIR):
+        """
+        Write a new version directory and then switch current.json to it,
+        so readers never see a half-written index.
+        The previous version is kept for readers that already opened current.json;
+        older ones are removed. Callers hold _index_file_lock.
+        """
+        previous = _current_version(path)
+        version = f"v{time.time_ns()}"
+        target = os.path.join(path, version)
+        os.makedirs(target)
+        np.save(os.path.join(target, "data.npy"), self.counts.data.astype(np.float32))
+        np.save(os.path.join(target, "indices.npy"), self.counts.indices.astype(np.int32))
+        np.save(os.path.join(target, "indptr.npy"), self.counts.indptr.astype(np.int64))
+        np.save(os.path.join(target, "neighbours.npy"), self.neighbours)
+        np.save(os.path.join(target, "scores.npy"), self.scores)
+        with open(os.path.join(target, "ids.json"), "w") as f:
+            json.dump({
+                "user_ids": self.user_ids,
+                "artist_ids": self.artist_ids,
+                "artist_names": self.artist_names,
+                "last_id": self.last_id,
+            }, f)
+
+        tmp = os.path.join(path, "current.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": version}, f)
+        os.replace(tmp, os.path.join(path, "current.json"))
+
+        for name in os.listdir(path):
+            if name.startswith("v") and name not in (version, previous):
+                # Old versions may still be mapped by another process on some platforms
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str = INDEX_DIR) -> Optional["SimilarityIndex"]:
+        """Load the current version with the arrays memory-mapped; None if nothing is saved"""
+        for attempt in range(LOAD_ATTEMPTS):
+            version = _current_version(path)
+            if version is None:
+                return None
+            try:
+                return cls._load_version(os.path.join(path, version))
+            except FileNotFoundError:
+                # Pruned by saves in another process since we read current.json; read it again
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+    @classmethod
+    def _load_version(cls, target: str) -> "SimilarityIndex":
+        with open(os.path.join(target, "ids.json")) as f:
+            ids = json.load(f)
+
+        def mapped(name):
+            return np.load(os.path.join(target, name), mmap_mode="r")
+
+        shape = (len(ids["user_ids"]), len(ids["artist_ids"]))
+        counts = sparse.csr_matrix(
+            (mapped("data.npy"), mapped("indices.npy"), mapped("indptr.npy")), shape=shape, copy=False
+        )
+        return cls(ids["user_ids"], ids["artist_ids"], ids["artist_names"], counts,
+                   mapped("neighbours.npy"), mapped("scores.npy"), ids["last_id"])
+
+def _current_version(path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(path, "current.json")) as f:
+            return json.load(f)["version"]
+    except FileNotFoundError:
+        return None
+
+# (index, mtime of the current.json it came from), replaced as one tuple so readers take no lock
+_loaded: Tuple[Optional[SimilarityIndex], Optional[float]] = (None, None)
+# Held only while publishing a loaded index
+_swap_lock = threading.Lock()
+# Serializes updates and rebuilds in this process; requests never wait on it
+_build_lock = threading.Lock()
+
+def _publish(index: Optional[SimilarityIndex], mtime: float):
+    global _loaded
+    with _swap_lock:
+        if _loaded[1] is None or mtime >= _loaded[1]:
+            _loaded = (index, mtime)
+
+def get_index(path: str = INDEX_DIR) -> Optional[SimilarityIndex]:
+    """Index for serving requests, reloaded when another process saves a new version"""
+    index, loaded_mtime = _loaded
+    try:
+        mtime = os.stat(os.path.join(path, "current.json")).st_mtime
+    except FileNotFoundError:
+        return index
+    if index is not None and mtime == loaded_mtime:
+        return index
+    try:
+        # Only maps the arrays, so concurrent requests may each load without harm
+        fresh = SimilarityIndex.load(path)
+    except FileNotFoundError as e:
+        # Keep serving the index we have and try again on the next request
+        print(f"Error loading recommendation index: {e}")
+        return index
+    _publish(fresh, mtime)
+    return fresh
+
+def update_index(db: Session, path: str = INDEX_DIR) -> Dict[str, Any]:
+    """Incrementally update (or first build) the saved index"""
+    with _build_lock, _index_file_lock(path):
+        index = SimilarityIndex.load(path)
+        if index is None:
+            index = SimilarityIndex.build(db)
+            affected = len(index.user_ids)
+        else:
+            affected = index.update(db)
+        if affected:
+            index.save(path)
+            _publish(index, os.stat(os.path.join(path, "current.json")).st_mtime)
+        return {"users_updated": affected, "users": len(index.user_ids), "artists": len(index.artist_ids)}
+
+def rebuild_index(db: Session, path: str = INDEX_DIR) -> Dict[str, Any]:
+    """Rebuild from scratch, refreshing every neighbour list"""
+    with _build_lock, _index_file_lock(path):
+        index = SimilarityIndex.build(db)
+        index.save(path)
+        _publish(index, os.stat(os.path.join(path, "current.json")).st_mtime)
+        return {"users": len(index.user_ids), "artists": len(index.artist_ids)}
@@ -0,0 +1,94 @@
+import hashlib
+import math
+import sys
+from array import array
+
+def _hash128(value: str) -> int:
+    """Stable 128-bit hash (Python's hash() is salted per process)"""
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest(), "big")
+
+class CountMinSketch:
+    """Approximate per-key counts in fixed memory (never undercounts)"""
+
+    def __init__(self, width: int = 1024, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.table = [array("I", bytes(4 * width)) for _ in range(depth)]
+
+    def _indexes(self, key: str):
+        h = _hash128(key)
+        h1, h2 = h >> 64, (h & 0xFFFFFFFFFFFFFFFF) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key: str, count: int = 1) -> int:
+        """Add count for key and return the new estimate"""
+        estimate = None
+        for row, idx in zip(self.table, self._indexes(key)):
+            row[idx] += count
+            estimate = row[idx] if estimate is None else min(estimate, row[idx])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[idx] for row, idx in zip(self.table, self._indexes(key)))
+
+    def to_bytes(self) -> bytes:
+        """Counters as little-endian uint32, row by row (width * depth * 4 bytes)"""
+        data = array("I", [c for row in self.table for c in row])
+        if sys.byteorder == "big":
+            data.byteswap()
+        return data.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, width: int, depth: int) -> "CountMinSketch":
+        sketch = cls(width, depth)
+        counters = array("I")
+        counters.frombytes(data)
+        if sys.byteorder == "big":
+            counters.byteswap()
+        if len(counters) != width * depth:
+            raise ValueError("Count-min sketch size mismatch")
+        sketch.table = [counters[i * width:(i + 1) * width] for i in range(depth)]
+        return sketch
+
+class HyperLogLog:
+    """Approximate distinct count in 2**precision bytes"""
+
+    def __init__(self, precision: int = 8):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value: str):
+        h = _hash128(value) >> 64
+        idx = h >> (64 - self.precision)
+        rest = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = 64 - self.precision + 1 if rest == 0 else 65 - rest.bit_length()
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+
+    def to_bytes(self) -> bytes:
+        """Registers, one byte each (2**precision bytes)"""
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, precision: int) -> "HyperLogLog":
+        hll = cls(precision)
+        if len(data) != hll.m:
+            raise ValueError("HyperLogLog size mismatch")
+        hll.registers = bytearray(data)
+        return hll
+
+    def count(self) -> int:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
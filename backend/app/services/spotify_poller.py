@@ -1,14 +1,20 @@
 import os
 import requests
 import datetime
-from typing import Optional, List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple
 from sqlalchemy.orm import Session
-from ..db.database import get_db_context
+from ..db.database import engine, get_db_context
 from .db_service import DBService
+from .ingest_buffer import get_ingest_buffer
 
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 
+def _init_poll_worker():
+    """Give each pool process its own connections instead of the parent's"""
+    engine.dispose(close=False)
+
 class SpotifyPoller:
     @staticmethod
     def refresh_access_token(db: Session, user_id: str, refresh_token: str) -> Optional[str]:
@@ -105,19 +111,11 @@ class SpotifyPoller:
         return tracks
     
     @staticmethod
-    def poll_user(db: Session, user_id: str) -> Dict[str, Any]:
-        """Poll listening history for a single user"""
-        result = {
-            "user_id": user_id,
-            "success": False,
-            "tracks_saved": 0,
-            "error": None
-        }
-        
+    def fetch_user_tracks(db: Session, user_id: str) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+        """Fetch and parse a user's recently played tracks; returns (tracks, error)"""
         user = DBService.get_user(db, user_id)
         if not user:
-            result["error"] = "User not found"
-            return result
+            return None, "User not found"
         
         # Check if token needs refresh
         access_token = user.access_token
@@ -125,56 +123,101 @@ class SpotifyPoller:
         
         if not access_token or not user.token_expiry or user.token_expiry <= now:
             if not user.refresh_token:
-                result["error"] = "No refresh token available"
-                return result
+                return None, "No refresh token available"
             
             access_token = SpotifyPoller.refresh_access_token(db, user_id, user.refresh_token)
             if not access_token:
-                result["error"] = "Failed to refresh token"
-                return result
+                return None, "Failed to refresh token"
         
         # Fetch recently played tracks
         spotify_data = SpotifyPoller.get_recently_played(access_token)
         if not spotify_data:
-            result["error"] = "Failed to fetch recently played"
-            return result
+            return None, "Failed to fetch recently played"
         
-        # Parse and save tracks
         tracks = SpotifyPoller.parse_tracks_data(spotify_data)
-        if tracks:
-            tracks_saved = DBService.save_listening_history(db, user_id, tracks)
-            result["tracks_saved"] = tracks_saved
-            result["success"] = True
-        else:
-            result["error"] = "No tracks found"
+        if not tracks:
+            return None, "No tracks found"
+        return tracks, None
+    
+    @staticmethod
+    def poll_user(db: Session, user_id: str) -> Dict[str, Any]:
+        """Poll listening history for a single user"""
+        result = {
+            "user_id": user_id,
+            "success": False,
+            "tracks_saved": 0,
+            "error": None
+        }
+        
+        tracks, error = SpotifyPoller.fetch_user_tracks(db, user_id)
+        if error:
+            result["error"] = error
+            return result
         
+        result["tracks_saved"] = DBService.save_listening_history(db, user_id, tracks)
+        result["success"] = True
         return result
     
     @staticmethod
-    def poll_all_users() -> List[Dict[str, Any]]:
-        """Poll listening history for all active users"""
+    def poll_users(user_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Poll listening history for the given users over one session
+        Plays go through the ingest buffer so many users share each write
+        """
         results = []
+        pending = []
+        ingest = get_ingest_buffer()
         
         with get_db_context() as db:
-            users = DBService.get_all_active_users(db)
-            print(f"Polling {len(users)} users...")
-            
-            for user in users:
+            for user_id in user_ids:
+                result = {
+                    "user_id": user_id,
+                    "success": False,
+                    "tracks_saved": 0,
+                    "error": None
+                }
+                results.append(result)
                 try:
-                    result = SpotifyPoller.poll_user(db, user.user_id)
-                    results.append(result)
-                    
-                    if result["success"]:
-                        print(f"✓ {user.user_id}: {result['tracks_saved']} new tracks")
+                    tracks, error = SpotifyPoller.fetch_user_tracks(db, user_id)
+                    if error:
+                        result["error"] = error
+                        print(f"✗ {user_id}: {error}")
                     else:
-                        print(f"✗ {user.user_id}: {result['error']}")
-                        
+                        pending.append((result, ingest.submit(user_id, tracks)))
                 except Exception as e:
-                    print(f"Error polling user {user.user_id}: {e}")
-                    results.append({
-                        "user_id": user.user_id,
-                        "success": False,
-                        "error": str(e)
-                    })
+                    print(f"Error polling user {user_id}: {e}")
+                    result["error"] = str(e)
+        
+        # Counts are only known once the buffered rows have been written
+        ingest.flush()
+        for result, future in pending:
+            try:
+                result["tracks_saved"] = future.result()
+                result["success"] = True
+                print(f"✓ {result['user_id']}: {result['tracks_saved']} new tracks")
+            except Exception as e:
+                print(f"✗ {result['user_id']}: {e}")
+                result["error"] = str(e)
+        
+        return results
+    
+    @staticmethod
+    def poll_all_users(workers: int = 0) -> List[Dict[str, Any]]:
+        """
+        Poll listening history for all active users
+        With workers > 1 the users are split across a process pool
+        """
+        with get_db_context() as db:
+            user_ids = [user.user_id for user in DBService.get_all_active_users(db)]
+        print(f"Polling {len(user_ids)} users...")
+        
+        if workers <= 1 or len(user_ids) <= 1:
+            return SpotifyPoller.poll_users(user_ids)
+        
+        chunks = [chunk for chunk in (user_ids[i::workers] for i in range(workers)) if chunk]
+        results = []
+        with ProcessPoolExecutor(max_workers=len(chunks), initializer=_init_poll_worker) as pool:
+            for chunk_results in pool.map(SpotifyPoller.poll_users, chunks):
+                results.extend(chunk_results)
         
-        return results
\ No newline at end of file
+        return results
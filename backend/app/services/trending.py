@@ -0,0 +1,302 @@
+import datetime
+import json
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from ..db.models import User, ListeningHistory, TrendingStat, GlobalStat, TrendingBucket, AggregationCheckpoint
+from .db_service import DBService
+from .sketches import CountMinSketch, HyperLogLog
+
+# Sliding windows served by the trending endpoints, in days
+TIMEFRAMES = {"day": 1, "week": 7, "month": 30}
+# Keep enough daily buckets to compare each window with the one before it
+RETENTION_DAYS = 2 * max(TIMEFRAMES.values())
+# Heavy-hitter candidates tracked per kind per daily bucket
+MAX_CANDIDATES = 200
+TOP_N = 50
+ALL_USERS = "all"
+CHECKPOINT = "trending"
+
+def cohort_for(created_at: Optional[datetime.datetime]) -> Optional[str]:
+    """Cohort a user belongs to, by signup year"""
+    return str(created_at.year) if created_at else None
+
+class _ItemSketch:
+    """Approximate play counts for one kind (artist or track) in one daily bucket"""
+
+    def __init__(self):
+        self.counts = CountMinSketch()
+        # item_id -> [estimated plays, listeners HLL, name, artist name]
+        self.candidates: Dict[str, list] = {}
+
+    def add(self, item_id: str, name: Optional[str], artist_name: Optional[str], listener: str):
+        estimate = self.counts.add(item_id)
+        candidate = self.candidates.get(item_id)
+        if candidate is None:
+            if len(self.candidates) >= MAX_CANDIDATES:
+                weakest = min(self.candidates, key=lambda k: self.candidates[k][0])
+                if self.candidates[weakest][0] >= estimate:
+                    return
+                del self.candidates[weakest]
+            candidate = self.candidates[item_id] = [estimate, HyperLogLog(), name, artist_name]
+        candidate[0] = estimate
+        candidate[1].add(listener)
+
+class _DayBucket:
+    """Everything the job knows about one cohort's plays on one UTC day"""
+
+    def __init__(self):
+        self.plays = 0
+        self.duration_ms = 0
+        self.listeners = HyperLogLog(precision=10)
+        self.artists = HyperLogLog(precision=10)
+        self.items = {"artist": _ItemSketch(), "track": _ItemSketch()}
+
+    def dump(self) -> Tuple[bytes, str]:
+        """Sketch bytes plus the JSON metadata needed to read them back"""
+        chunks = [self.listeners.to_bytes(), self.artists.to_bytes()]
+        items = {}
+        for kind, sketch in self.items.items():
+            chunks.append(sketch.counts.to_bytes())
+            candidates = []
+            for item_id, (estimate, hll, name, artist_name) in sketch.candidates.items():
+                chunks.append(hll.to_bytes())
+                candidates.append([item_id, estimate, name, artist_name, hll.precision])
+            items[kind] = {"width": sketch.counts.width, "depth": sketch.counts.depth, "candidates": candidates}
+        meta = {
+            "plays": self.plays,
+            "duration_ms": self.duration_ms,
+            "precision": self.listeners.precision,
+            "items": items,
+        }
+        return b"".join(chunks), json.dumps(meta)
+
+    @classmethod
+    def load(cls, data: bytes, meta: str) -> "_DayBucket":
+        meta = json.loads(meta)
+        pos = 0
+
+        def take(size: int) -> bytes:
+            nonlocal pos
+            chunk = data[pos:pos + size]
+            pos += size
+            return chunk
+
+        bucket = cls()
+        bucket.plays = meta["plays"]
+        bucket.duration_ms = meta["duration_ms"]
+        precision = meta["precision"]
+        bucket.listeners = HyperLogLog.from_bytes(take(1 << precision), precision)
+        bucket.artists = HyperLogLog.from_bytes(take(1 << precision), precision)
+        for kind, info in meta["items"].items():
+            sketch = _ItemSketch()
+            width, depth = info["width"], info["depth"]
+            sketch.counts = CountMinSketch.from_bytes(take(4 * width * depth), width, depth)
+            for item_id, estimate, name, artist_name, hll_precision in info["candidates"]:
+                hll = HyperLogLog.from_bytes(take(1 << hll_precision), hll_precision)
+                sketch.candidates[item_id] = [estimate, hll, name, artist_name]
+            bucket.items[kind] = sketch
+        if pos != len(data):
+            raise ValueError("Trending bucket size mismatch")
+        return bucket
+
+class TrendingAggregator:
+    """
+    Incrementally folds new listening_history rows into bounded per-day sketches
+    and rebuilds the trending_stats/global_stats summary tables from them
+    """
+
+    def __init__(self):
+        # In-memory copy of the persisted state, valid while last_id matches the checkpoint
+        self.last_id: Optional[int] = None
+        self.buckets: Dict[Tuple[str, datetime.date], _DayBucket] = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def _lock_checkpoint(self, db: Session) -> AggregationCheckpoint:
+        """Row-lock the checkpoint so only one process aggregates at a time"""
+        query = db.query(AggregationCheckpoint).filter(AggregationCheckpoint.name == CHECKPOINT)
+        checkpoint = query.with_for_update().first()
+        if checkpoint is None:
+            try:
+                with db.begin_nested():
+                    db.add(AggregationCheckpoint(name=CHECKPOINT, last_id=0))
+            except IntegrityError:
+                # Another process created it first
+                pass
+            checkpoint = query.with_for_update().first()
+        return checkpoint
+
+    def _load(self, db: Session, last_id: int):
+        """Replace the in-memory buckets with the persisted ones"""
+        self.buckets = {
+            (row.cohort, row.day): _DayBucket.load(bytes(row.sketch), row.meta)
+            for row in db.query(TrendingBucket).all()
+        }
+        self.last_id = last_id
+
+    def _save(self, db: Session, checkpoint: AggregationCheckpoint, today: datetime.date):
+        """Persist changed buckets and the checkpoint in the caller's transaction"""
+        for cohort, day in self.dirty:
+            if (cohort, day) in self.buckets:
+                sketch, meta = self.buckets[(cohort, day)].dump()
+                db.merge(TrendingBucket(cohort=cohort, day=day, sketch=sketch, meta=meta))
+        oldest = today - datetime.timedelta(days=RETENTION_DAYS - 1)
+        db.query(TrendingBucket).filter(TrendingBucket.day < oldest).delete(synchronize_session=False)
+        checkpoint.last_id = self.last_id
+        self.dirty = set()
+
+    def ingest(self, db: Session, batch_size: int = 5000) -> int:
+        """
+        Read rows added since the last run; returns the number of rows ingested.
+        Only reads up to the settled id, so rows still being committed with lower
+        ids are picked up next run instead of being skipped for good.
+        """
+        settled_id = DBService.get_settled_history_id(db)
+        if settled_id <= self.last_id:
+            return 0
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=RETENTION_DAYS)
+        rows = db.query(
+            ListeningHistory.id,
+            ListeningHistory.user_id,
+            ListeningHistory.track_id,
+            ListeningHistory.track_name,
+            ListeningHistory.artist_id,
+            ListeningHistory.artist_name,
+            ListeningHistory.played_at,
+            ListeningHistory.duration_ms,
+            User.created_at,
+        ).join(User, User.user_id == ListeningHistory.user_id)\
+            .filter(
+                ListeningHistory.id > self.last_id,
+                ListeningHistory.id <= settled_id,
+                ListeningHistory.played_at >= cutoff
+            )\
+            .order_by(ListeningHistory.id)\
+            .yield_per(batch_size)
+
+        count = 0
+        for row in rows:
+            played_at = row.played_at
+            if played_at.tzinfo is None:
+                # If naive, assume UTC
+                played_at = played_at.replace(tzinfo=datetime.timezone.utc)
+            day = played_at.astimezone(datetime.timezone.utc).date()
+            for cohort in (ALL_USERS, cohort_for(row.created_at)):
+                if cohort:
+                    self._add(cohort, day, row)
+            count += 1
+        # Rows older than the retention window are filtered out but still covered
+        self.last_id = settled_id
+        return count
+
+    def _add(self, cohort: str, day: datetime.date, row):
+        bucket = self.buckets.get((cohort, day))
+        if bucket is None:
+            bucket = self.buckets[(cohort, day)] = _DayBucket()
+        self.dirty.add((cohort, day))
+        bucket.plays += 1
+        bucket.duration_ms += row.duration_ms or 0
+        bucket.listeners.add(row.user_id)
+        if row.artist_id:
+            bucket.artists.add(row.artist_id)
+            bucket.items["artist"].add(row.artist_id, row.artist_name, None, row.user_id)
+        if row.track_id:
+            bucket.items["track"].add(row.track_id, row.track_name, row.artist_name, row.user_id)
+
+    def evict_expired(self, today: datetime.date):
+        """Drop daily buckets that have slid out of every window"""
+        oldest = today - datetime.timedelta(days=RETENTION_DAYS - 1)
+        for key in [k for k in self.buckets if k[1] < oldest]:
+            del self.buckets[key]
+
+    def _days(self, cohort: str, end: datetime.date, days: int) -> List[_DayBucket]:
+        return [
+            self.buckets[(cohort, end - datetime.timedelta(days=i))]
+            for i in range(days)
+            if (cohort, end - datetime.timedelta(days=i)) in self.buckets
+        ]
+
+    def _global_stat(self, cohort: str, timeframe: str, window: List[_DayBucket]) -> GlobalStat:
+        listeners, artists = HyperLogLog(precision=10), HyperLogLog(precision=10)
+        for bucket in window:
+            listeners.merge(bucket.listeners)
+            artists.merge(bucket.artists)
+        return GlobalStat(
+            cohort=cohort,
+            timeframe=timeframe,
+            total_plays=sum(b.plays for b in window),
+            total_minutes=round(sum(b.duration_ms for b in window) / (1000 * 60), 1),
+            unique_listeners=listeners.count(),
+            unique_artists=artists.count(),
+        )
+
+    def _top_items(self, cohort: str, timeframe: str, kind: str,
+                   window: List[_DayBucket], previous: List[_DayBucket]) -> List[TrendingStat]:
+        candidates: Dict[str, list] = {}
+        for bucket in window:
+            for item_id, (_, hll, name, artist_name) in bucket.items[kind].candidates.items():
+                entry = candidates.get(item_id)
+                if entry is None:
+                    entry = candidates[item_id] = [HyperLogLog(), name, artist_name]
+                entry[0].merge(hll)
+
+        scored = [
+            (sum(b.items[kind].counts.estimate(item_id) for b in window), item_id)
+            for item_id in candidates
+        ]
+        scored.sort(reverse=True)
+
+        stats = []
+        for rank, (plays, item_id) in enumerate(scored[:TOP_N], start=1):
+            hll, name, artist_name = candidates[item_id]
+            stats.append(TrendingStat(
+                cohort=cohort,
+                timeframe=timeframe,
+                kind=kind,
+                rank=rank,
+                item_id=item_id,
+                item_name=name,
+                artist_name=artist_name,
+                play_count=plays,
+                previous_play_count=sum(b.items[kind].counts.estimate(item_id) for b in previous),
+                unique_listeners=hll.count(),
+            ))
+        return stats
+
+    def rebuild_summaries(self, db: Session, today: datetime.date):
+        """Replace the summary tables with the current sliding-window view"""
+        self.evict_expired(today)
+        cohorts = {cohort for cohort, _ in self.buckets} | {ALL_USERS}
+
+        db.query(TrendingStat).delete(synchronize_session=False)
+        db.query(GlobalStat).delete(synchronize_session=False)
+        for cohort in sorted(cohorts):
+            for timeframe, days in TIMEFRAMES.items():
+                window = self._days(cohort, today, days)
+                previous = self._days(cohort, today - datetime.timedelta(days=days), days)
+                db.add(self._global_stat(cohort, timeframe, window))
+                for kind in ("artist", "track"):
+                    db.add_all(self._top_items(cohort, timeframe, kind, window, previous))
+
+    def run(self, db: Session) -> Dict[str, Any]:
+        """Ingest new plays and refresh the summary tables"""
+        with self.lock:
+            checkpoint = self._lock_checkpoint(db)
+            if self.last_id != checkpoint.last_id:
+                # First run in this process, or another process has aggregated since
+                self._load(db, checkpoint.last_id)
+            today = datetime.datetime.now(datetime.timezone.utc).date()
+            try:
+                ingested = self.ingest(db)
+                self._save(db, checkpoint, today)
+                self.rebuild_summaries(db, today)
+            except Exception:
+                # The transaction rolls back, so drop state that was never persisted
+                self.last_id = None
+                self.dirty = set()
+                raise
+            return {"ingested": ingested, "buckets": len(self.buckets), "last_id": self.last_id}
+
+aggregator = TrendingAggregator()
@@ -2,7 +2,7 @@ import './GraphCard.css';
 import LineChart from '../Components/LineChart';
 import GraphControls from '../Components/GraphControls';
 import { useEffect, useState, useRef } from "react";
-import { getListeningData, getEarliestDate } from "../getListeningData";
+import { getListeningSeries, getEarliestDate } from "../getListeningData";
 import { chartListeningData } from "../chartListeningData";
 
 // Helper function to get the current week's start and end dates
@@ -77,7 +77,7 @@ function GraphCard({ title, userId, dataType=null, artistId=null, artistName=nul
             const name = artistNames[i] || `Artist ${i+1}`;
             
             console.log(`Fetching data for ${name} (${id})`);
-            const { rawData } = await getListeningData(userId, dateRange.startDate, dateRange.endDate, id, 800);
+            const { rawData } = await getListeningSeries(userId, dateRange.startDate, dateRange.endDate, id);
             
             // Process this artist's data
             const artistData = chartListeningData(rawData, dateRange.startDate, dateRange.endDate, name);
@@ -101,12 +101,12 @@ function GraphCard({ title, userId, dataType=null, artistId=null, artistName=nul
         // Case 2: Single artist (using artistId)
         else if (dataType === "artist" && artistId) {
           console.log("Fetching listening data for artist", artistId);
-          const { rawData } = await getListeningData(userId, dateRange.startDate, dateRange.endDate, artistId, 1000);
+          const { rawData } = await getListeningSeries(userId, dateRange.startDate, dateRange.endDate, artistId);
           processedData = chartListeningData(rawData, dateRange.startDate, dateRange.endDate, artistName);
         }
         // Case 3: Default total listening data
         else {
-          const { rawData } = await getListeningData(userId, dateRange.startDate, dateRange.endDate, null, 1500);
+          const { rawData } = await getListeningSeries(userId, dateRange.startDate, dateRange.endDate);
           processedData = chartListeningData(rawData, dateRange.startDate, dateRange.endDate, "Minutes Listened", pointImage);
         }
         
@@ -62,6 +62,38 @@ export async function getListeningData(userId, startDate = null, endDate = null,
   }
 }
 
+// Fetch pre-bucketed daily totals from the backend instead of downloading raw plays.
+// Returns rawData in the same { date, duration_ms } shape chartListeningData expects.
+export async function getListeningSeries(userId, startDate, endDate, artistId = null) {
+  if (!userId || !startDate || !endDate) {
+    console.error("No userId or date range provided");
+    return { rawData: [] };
+  }
+
+  const params = new URLSearchParams({
+    start_date: startDate,
+    end_date: endDate,
+    bucket: "day",
+    tz: Intl.DateTimeFormat().resolvedOptions().timeZone || "UTC",
+  });
+  if (artistId) {
+    params.set("artist_id", artistId);
+  }
+
+  try {
+    const response = await fetch(`${import.meta.env.VITE_API_URL}/api/user/${userId}/listening-series?${params}`);
+    if (!response.ok) {
+      throw new Error(`HTTP ${response.status}`);
+    }
+    const { series } = await response.json();
+    const rawData = series.map(({ period, minutes }) => ({ date: period, duration_ms: minutes * 60000 }));
+    return { rawData };
+  } catch (error) {
+    console.error("Error fetching listening series:", error);
+    return { rawData: [] };
+  }
+}
+
 export async function getListeningDataForDay(userId, date) {
   if (!userId || !date) {
     console.error("No userId or date provided");